@@ -1,7 +1,9 @@
 #!/usr/bin/python3
 
+import hashlib
+import os
+
 from nmigen import *
-from nmigen.lib.cdc import FFSynchronizer
 from nmigen.lib.io import Pin
 from nmigen.build import *
 from nmigen.vendor.lattice_ecp5 import *
@@ -30,8 +32,9 @@ def _wire_layout():
 
 
 class JTAGtoSPI(Elaboratable):
-    def __init__(self, *, bits=32, spi_pins=None, **kwargs):
+    def __init__(self, *, bits=32, spi_pins=None, miso_reg=False, **kwargs):
         self._bits = bits
+        self._miso_reg = miso_reg
 
         self._spi_pins = spi_pins
         self.jtag = Record(_wire_layout())
@@ -49,27 +52,20 @@ class JTAGtoSPI(Elaboratable):
         self.jtag_sel1_shift   = Signal()   # JTAG chain 1 is selected & in Shift-DR state?
 
         # For JTAGF/JTAGG
-        if set(kwargs).intersection(["jtagf", "jtagg"]):
-            if kwargs.get("jtagf"):
-                self._jtagf = True
-            elif kwargs.get("jtagg"):
-                self._jtagg = True
-            else:
-                raise KeyError("Can't use JTAGF and JTAGG at the same time")
+        if kwargs.get("jtagf") and kwargs.get("jtagg"):
+            raise KeyError("Can't use JTAGF and JTAGG at the same time")
+        self._jtag_name = ("JTAGG" if kwargs.get("jtagg") else
+                           "JTAGF" if kwargs.get("jtagf") else None)
 
 
     def _detect_jtag_state(self, module):
         # JTAGF / JTAGG
-        if True in [hasattr(self, t) for t in ["_jtagf", "_jtagg"]]:
+        if self._jtag_name is not None:
             # Add a JTAGG module to expose internal JTAG signals to FPGA
-            if hasattr(self, "_jtagf"):
-                jtag_name = "JTAGF"
-            elif hasattr(self, "_jtagg"):
-                jtag_name = "JTAGG"
             jtag_sel1_capture_or_shift = Signal()
             jtag_rti1 = Signal()
             jtag_rst_n = Signal()
-            module.submodules += Instance(jtag_name,
+            module.submodules += Instance(self._jtag_name,
                                           i_JTDO1=self.jtag.tdo,
                                           o_JTDI=self.jtag.tdi,
                                           o_JTCK=self.jtag.tck,
@@ -103,7 +99,6 @@ class JTAGtoSPI(Elaboratable):
         m = Module()
 
         bits = Signal(self._bits, reset_less=True)
-        head = Signal(range(len(bits)), reset=len(bits)-1)
         m.domains.sync = cd_sync = ClockDomain()
 
         if self._spi_pins is not None:
@@ -117,6 +112,8 @@ class JTAGtoSPI(Elaboratable):
                 self._spi_pins.hold.eq(1)
             ]
             self._detect_jtag_state(m)
+            # 33 ns TCK, as JTAG2SPI.tck_period in xilinx_bscan_spi.py
+            platform.add_clock_constraint(self.jtag.tck, 1/33e-9)
         # For simulation purpose using no Pins:
         else:
             m.d.comb += [
@@ -130,11 +127,16 @@ class JTAGtoSPI(Elaboratable):
             self.cs_n.oe.eq(self.jtag.sel),
             self.clk.oe.eq(self.jtag.sel),
             self.mosi.oe.eq(self.jtag.sel),
-            self.jtag.tdo.eq(self.miso.i),
             # Positive edge: JTAG TAP outputs; SPI device gets input from FPGA
             # Negative edge: JTAG TAP gets input; SPI device outputs to FPGA
             self.clk.o.eq(~self.jtag.tck),
         ]
+        if self._miso_reg:
+            # Register MISO on rising TCK: one more TCK cycle of latency,
+            # the host needs to shift one extra bit to read the data
+            m.d.sync += self.jtag.tdo.eq(self.miso.i)
+        else:
+            m.d.comb += self.jtag.tdo.eq(self.miso.i)
 
         # Latency calculation (in half cycles):
         # 0 (falling TCK, rising CLK):
@@ -149,14 +151,14 @@ class JTAGtoSPI(Elaboratable):
         #   JTAG adapter: sample TDO
         with m.FSM() as fsm:
             with m.State("IDLE"):
+                # Preload a marker bit. It is shifted up by the header bits
+                # and reaches the MSB when the last header bit is due.
+                m.d.sync += bits.eq(1)
                 with m.If(self.jtag_sel1_shift & self.jtag.tdi):
                     m.next = "HEAD"
             with m.State("HEAD"):
-                m.d.sync += [
-                    bits.eq(Cat(self.jtag.tdi, bits)),
-                    head.eq(head - 1)
-                ]
-                with m.If(head == 0):
+                m.d.sync += bits.eq(Cat(self.jtag.tdi, bits))
+                with m.If(bits[-1]):
                     m.next = "XFER"
             with m.State("XFER"):
                 m.d.sync += bits.eq(bits - 1)
@@ -191,9 +193,13 @@ class LatticeECP5(Elaboratable):
                                  i_USRMCLKI=j2s.clk,
                                  i_USRMCLKTS=0)
 
-        # For some reason, the clk100 must be requested and used to drive a domain in the design
-        m.domains.clk100 = cd_clk100 = ClockDomain(reset_less=True)
-        m.d.comb += cd_clk100.clk.eq(platform.request("clk100").i)
+        # For some reason, a second clock must drive a domain in the design.
+        # Use the internal oscillator (310 MHz / 128) rather than an external
+        # clock pin.
+        m.domains.osc = cd_osc = ClockDomain(reset_less=True)
+        m.submodules += Instance("OSCG",
+                                 p_DIV=128,
+                                 o_OSC=cd_osc.clk)
 
         return m
 
@@ -213,16 +219,10 @@ class LatticeECP5BscanSpi(LatticeECP5Platform):
                                   name_suffix="1x"))
         return io
 
-    def make_clk():
-        return (
-            Resource("clk100", 0, DiffPairs("P3", "P4", dir="i"),
-                     Clock(100e6), Attrs(IO_TYPE="LVDS"))
-        )
-
     device     = "LFE5UM-45F"
     package    = "BG381"
     speed      = "8"
-    resources  = [*make_spi(), make_clk()]
+    resources  = [*make_spi()]
     connectors = []
     top_class  = LatticeECP5
 
@@ -241,14 +241,48 @@ class LatticeBscanSpi:
         newcls.__init__(self, *args, **kwargs)
         return self
 
+    @staticmethod
+    def digest(*data):
+        """SHA256 of this script, the nMigen version and `data`"""
+        with open(__file__, "rb") as f:
+            h = hashlib.sha256(f.read())
+        try:
+            from importlib import metadata
+            data += (metadata.version("nmigen"),)
+        except ImportError:  # Python < 3.8 or PackageNotFoundError
+            pass
+        h.update(repr(data).encode())
+        return h.hexdigest()
+
+    @classmethod
+    def up_to_date(cls, target):
+        name = os.path.join("build", "bscan_spi_{}".format(
+            target.lower().replace("-","")))
+        try:
+            with open(name + ".sha256") as f:
+                stamp = f.read()
+        except FileNotFoundError:
+            return False
+        return stamp == cls.digest(target) and os.path.exists(name + ".bit")
+
+    @classmethod
+    def stamp(cls, target):
+        name = os.path.join("build", "bscan_spi_{}".format(
+            target.lower().replace("-","")))
+        with open(name + ".sha256", "w") as f:
+            f.write(cls.digest(target))
+
     @classmethod
     def make(cls, target, errors=False):
+        name = "bscan_spi_{}".format(target.lower().replace("-",""))
+        if cls.up_to_date(target):
+            return
         Top = cls.targets[target].top_class
         platform = cls(target, Top.toolchain)
         top = Top(platform)
-        name = "bscan_spi_{}".format(target.lower().replace("-",""))
         try:
             platform.build(top, name=name)
+            cls.stamp(target)
         except Exception as e:
             print(("ERROR: lattice_bscan_spi build failed for {}: {}")
                   .format(target, e))
@@ -267,5 +301,10 @@ if __name__ == "__main__":
     p.add_argument("-p", "--parallel", default=1, type=int,
                    help="number of parallel builds (default: %(default)s)")
     args = p.parse_args()
-    pool = multiprocessing.Pool(args.parallel)
-    pool.map(LatticeBscanSpi.make, args.device, chunksize=1)
+    # fork (where available) lets the workers share the already imported
+    # modules and tables instead of re-importing them
+    if "fork" in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method("fork")
+    with multiprocessing.Pool(args.parallel, maxtasksperchild=1) as pool:
+        for _ in pool.imap_unordered(LatticeBscanSpi.make, args.device):
+            pass
@@ -13,12 +13,17 @@
 #  GNU General Public License for more details.
 #
 
+import functools
+import hashlib
+import os
+import subprocess
 import unittest
 
 import migen as mg
 import migen.build.generic_platform as mb
 from migen.genlib import io
-from migen.build import xilinx
+from migen.build import tools, xilinx
+from migen.build.xilinx import common, vivado
 
 
 """
@@ -43,7 +48,10 @@ Notes:
 * The JTAG2SPI DR is 1 bit long (due to different sampling edges of
   {MISO,MOSI}/{TDO,TDI}).
 * MOSI is TDI with half a cycle delay.
-* TDO is MISO with half a cycle delay.
+* TDO is MISO with half a cycle delay (one and a half cycles with the
+  optional MISO register).
+* All registers are in a single clock domain on rising TCK. CLK is TCK
+  inverted, no falling edge registers are needed.
 * CAPTURE-DR needs to be performed before SHIFT-DR on the BYPASSed TAPs in
   JTAG chain to clear the BYPASS registers to 0.
 
@@ -52,7 +60,19 @@ https://github.com/m-labs/migen
 
 
 class JTAG2SPI(mg.Module):
-    def __init__(self, spi=None, bits=32):
+    # TCK period (ns) for timing the SPI pads: 30 MHz, the fastest TCK of the
+    # common FT2232H/FT232H based adapters
+    tck_period = 33
+    # SPI flash timing (ns), worst case of common 3.3 V SPI NOR flashes
+    # (e.g. Micron MT25Q, Winbond W25Q): CS_N/MOSI setup and hold to rising
+    # CLK, MISO valid and hold after falling CLK
+    t_su = 4
+    t_h = 4
+    t_v = 7
+    t_oh = 1
+
+    def __init__(self, spi=None, bits=32, miso_reg=False):
+        self.miso_reg = miso_reg
         self.jtag = mg.Record([
             ("sel", 1),
             ("shift", 1),
@@ -71,7 +91,7 @@ class JTAG2SPI(mg.Module):
         self.cs_n.o.reset = mg.Constant(1)
         self.mosi.o.reset_less = True
         bits = mg.Signal(bits, reset_less=True)
-        head = mg.Signal(max=len(bits), reset=len(bits) - 1)
+        head = mg.Signal((len(bits) - 1).bit_length(), reset=len(bits) - 1)
         self.clock_domains.cd_sys = mg.ClockDomain()
         self.submodules.fsm = mg.FSM("IDLE")
         if spi is not None:
@@ -95,8 +115,15 @@ class JTAG2SPI(mg.Module):
                 # https://www.xilinx.com/support/answers/52626.html
                 # This is fine since CS_N changes only on falling CLK.
                 self.clk.o.eq(~self.jtag.tck),
-                self.jtag.tdo.eq(self.miso.i),
         ]
+        if miso_reg:
+            # Register MISO on rising TCK. This breaks the MISO-TDO path
+            # through the pads and the BSCAN primitive at the cost of one
+            # more TCK cycle of latency: the host needs to shift one extra
+            # bit to read the data.
+            self.sync += self.jtag.tdo.eq(self.miso.i)
+        else:
+            self.comb += self.jtag.tdo.eq(self.miso.i)
         # Latency calculation (in half cycles):
         # 0 (falling TCK, rising CLK):
         #   JTAG adapter: set TDI
@@ -135,6 +162,41 @@ class JTAG2SPI(mg.Module):
                 )
         ]
 
+    def add_io_constraints(self, platform, spi):
+        """Constrain the SPI pads relative to TCK (Vivado XDC).
+
+        CS_N and MOSI are launched on rising TCK and sampled by the flash on
+        rising CLK, i.e. falling TCK: output delays of t_su/-t_h against the
+        falling edge leave tck_period/2 - t_su for the FPGA side.
+
+        MISO is launched by the flash on falling CLK, i.e. rising TCK, and
+        is valid t_v after it. Without `miso_reg` it only drives TDO
+        combinationally and ends in the BSCAN primitive, which is not a timed
+        endpoint, so it is left unconstrained. With `miso_reg` it is
+        captured one TCK period later: input delays of t_v/t_oh leave
+        tck_period - t_v.
+
+        The CCLK path through STARTUPE2/STARTUPE3 is not modelled, the
+        margins above cover it at tck_period.
+        """
+        signals = dict(tck=self.jtag.tck,
+                       cs_n=spi.cs_n, mosi=spi.mosi, miso=spi.miso)
+        constraints = [
+                "set_output_delay -clock [get_clocks {tck}] -clock_fall "
+                "-max " + str(self.t_su) + " [get_ports {{{cs_n} {mosi}}}]",
+                "set_output_delay -clock [get_clocks {tck}] -clock_fall "
+                "-min " + str(-self.t_h) + " [get_ports {{{cs_n} {mosi}}}]",
+        ]
+        if self.miso_reg:
+            constraints += [
+                "set_input_delay -clock [get_clocks {tck}] "
+                "-max " + str(self.t_v) + " [get_ports {miso}]",
+                "set_input_delay -clock [get_clocks {tck}] "
+                "-min " + str(self.t_oh) + " [get_ports {miso}]",
+            ]
+        for c in constraints:
+            platform.toolchain.constraints.append((c, signals))
+
 
 class JTAG2SPITest(unittest.TestCase):
     def setUp(self):
@@ -198,6 +260,17 @@ class JTAG2SPITest(unittest.TestCase):
         for l in spi:
             print(l)
 
+    def test_miso_reg(self):
+        def check(dut, delay):
+            yield dut.miso.i.eq(1)
+            for i in range(delay):
+                self.assertEqual((yield dut.jtag.tdo), 0)
+                yield
+            self.assertEqual((yield dut.jtag.tdo), 1)
+        mg.run_simulation(self.dut, check(self.dut, 1))
+        dut = JTAG2SPI(bits=self.bits, miso_reg=True)
+        mg.run_simulation(dut, check(dut, 2))
+
 
 class Spartan3(mg.Module):
     macro = "BSCAN_SPARTAN3"
@@ -249,7 +322,8 @@ class Series7(mg.Module):
             "set_property BITSTREAM.GENERAL.COMPRESS True [current_design]",
             "set_property BITSTREAM.CONFIG.UNUSEDPIN Pullnone [current_design]"
         ])
-        self.submodules.j2s = j2s = JTAG2SPI(platform.request("spiflash"))
+        spi = platform.request("spiflash")
+        self.submodules.j2s = j2s = JTAG2SPI(spi)
         # clk = mg.Signal()
         self.specials += [
                 mg.Instance(
@@ -265,7 +339,8 @@ class Series7(mg.Module):
                     i_USRDONEO=1, i_USRDONETS=1),
                 # mg.Instance("BUFG", i_I=clk, o_O=j2s.jtag.tck)
         ]
-        platform.add_period_constraint(j2s.jtag.tck, 6)
+        platform.add_period_constraint(j2s.jtag.tck, j2s.tck_period)
+        j2s.add_io_constraints(platform, spi)
         try:
             self.comb += [
                     platform.request("user_sma_gpio_p").eq(j2s.cs_n.i),
@@ -286,7 +361,8 @@ class Ultrascale(mg.Module):
             "set_property BITSTREAM.CONFIG.UNUSEDPIN Pullnone [current_design]",
         ])
         self.submodules.j2s0 = j2s0 = JTAG2SPI()
-        self.submodules.j2s1 = j2s1 = JTAG2SPI(platform.request("spiflash"))
+        spi = platform.request("spiflash")
+        self.submodules.j2s1 = j2s1 = JTAG2SPI(spi)
         di = mg.Signal(4)
         self.comb += mg.Cat(j2s0.mosi.i, j2s0.miso.i).eq(di)
         self.specials += [
@@ -310,8 +386,75 @@ class Ultrascale(mg.Module):
                     i_DO=mg.Cat(j2s0.mosi.o, j2s0.miso.o, 0, 0),
                     i_DTS=mg.Cat(~j2s0.mosi.oe, ~j2s0.miso.oe, 1, 1))
         ]
-        platform.add_period_constraint(j2s0.jtag.tck, 6)
-        platform.add_period_constraint(j2s1.jtag.tck, 6)
+        platform.add_period_constraint(j2s0.jtag.tck, j2s0.tck_period)
+        platform.add_period_constraint(j2s1.jtag.tck, j2s1.tck_period)
+        # The two BSCANE2 DRCK clocks only meet in the STARTUPE3 CCLK mux
+        platform.add_false_path_constraint(j2s0.jtag.tck, j2s1.jtag.tck)
+        j2s1.add_io_constraints(platform, spi)
+
+
+class VivadoToolchain(vivado.XilinxVivadoToolchain):
+    def __init__(self):
+        vivado.XilinxVivadoToolchain.__init__(self)
+        # Synthesized netlist shared between targets with identical logic
+        # and pinout. Written by the first build, linked by the others.
+        self.netlist = None
+        # Top cell name if not the build name. Targets sharing a netlist
+        # also share its top cell and need a name that fits all of them.
+        self.top = None
+        # step: directive. The design is tiny and has ample timing slack:
+        # trade QoR for runtime.
+        self.directives = {
+            step: "RuntimeOptimized" for step in
+            ["synth_design", "opt_design", "place_design", "route_design"]}
+        # (command, signals): XDC commands referring to the clocks, emitted
+        # after the clock definitions
+        self.constraints = []
+        # Reuse placement and routing from the previous build of the same
+        # target (its routed checkpoint) where the netlist still matches.
+        self.incremental = False
+
+    def _constrain(self, platform):
+        vivado.XilinxVivadoToolchain._constrain(self, platform)
+        for command, signals in self.constraints:
+            platform.add_platform_command(command, **signals)
+
+    def _build_batch(self, platform, sources, edifs, ips, build_name):
+        vivado.XilinxVivadoToolchain._build_batch(
+            self, platform, sources, edifs, ips, build_name)
+        with open(build_name + ".tcl") as f:
+            tcl = f.read().split("\n")
+        for i, line in enumerate(tcl):
+            step = line.split(" ", 1)[0]
+            if step in self.directives:
+                tcl[i] += " -directive {}".format(self.directives[step])
+        if self.top is not None:
+            i = [line.split(" ", 1)[0] for line in tcl].index("synth_design")
+            tcl[i] = tcl[i].replace("-top {} ".format(build_name),
+                                    "-top {} ".format(self.top))
+        if self.incremental:
+            i = [line.split(" ", 1)[0] for line in tcl].index("opt_design")
+            tcl.insert(i + 1,
+                "if {{[file exists {0}_route.dcp]}} "
+                "{{ read_checkpoint -incremental {0}_route.dcp }}".format(
+                    build_name))
+        if self.netlist is not None:
+            i = [line.split(" ", 1)[0] for line in tcl].index("synth_design")
+            tcl[i:i + 1] = [
+                "if {{[file exists {{{}}}]}} {{".format(self.netlist),
+                "    remove_files {{{}.v}}".format(build_name),
+                "    read_edif {{{}}}".format(self.netlist),
+                "    link_design -part {}".format(platform.device),
+                "} else {",
+                "    " + tcl[i],
+                "    write_edif -force {{{}.{}.tmp}}".format(
+                    self.netlist, build_name),
+                "    file rename -force {{{0}.{1}.tmp}} {{{0}}}".format(
+                    self.netlist, build_name),
+                "}",
+            ]
+        with open(build_name + ".tcl", "w") as f:
+            f.write("\n".join(tcl))
 
 
 class XilinxBscanSpi(xilinx.XilinxPlatform):
@@ -430,16 +573,31 @@ class XilinxBscanSpi(xilinx.XilinxPlatform):
         "xcku040": ("ffva1156-2-e", 1, "LVCMOS18", Ultrascale),
     }
 
+    # device families by decreasing build time, used to schedule the longest
+    # builds first
+    build_order = ["xcku", "xc7v", "xc7k", "xc7a", "xc7s", "xc6slx", "xc3s"]
+
+    # extra IOs by device: SPI signals mirrored for debugging
+    debug_ios = {
+        "xc7k325t-ffg900-1": [
+            ("user_sma_clock_p", 0, mb.Pins("L25"), mb.IOStandard("LVCMOS25")),
+            ("user_sma_clock_n", 0, mb.Pins("K25"), mb.IOStandard("LVCMOS25")),
+            ("user_sma_gpio_p", 0, mb.Pins("Y23"), mb.IOStandard("LVCMOS25")),
+            ("user_sma_gpio_n", 0, mb.Pins("Y24"), mb.IOStandard("LVCMOS25")),
+        ],
+    }
+
     def __init__(self, device, pins, std, toolchain="ise"):
         ios = [self.make_spi(0, pins, std, toolchain)]
-        if device == "xc7k325t-ffg900-1":  # debug
-            ios += [
-                ("user_sma_clock_p", 0, mb.Pins("L25"), mb.IOStandard("LVCMOS25")),
-                ("user_sma_clock_n", 0, mb.Pins("K25"), mb.IOStandard("LVCMOS25")),
-                ("user_sma_gpio_p", 0, mb.Pins("Y23"), mb.IOStandard("LVCMOS25")),
-                ("user_sma_gpio_n", 0, mb.Pins("Y24"), mb.IOStandard("LVCMOS25")),
-            ]
+        ios += self.debug_ios.get(device, [])
         xilinx.XilinxPlatform.__init__(self, device, ios, toolchain=toolchain)
+        if toolchain == "vivado":
+            self.toolchain = VivadoToolchain()
+
+    def get_verilog(self, *args, **kwargs):
+        if getattr(self.toolchain, "top", None) is not None:
+            kwargs["name"] = self.toolchain.top
+        return xilinx.XilinxPlatform.get_verilog(self, *args, **kwargs)
 
     @staticmethod
     def make_spi(i, pins, std, toolchain):
@@ -460,20 +618,172 @@ class XilinxBscanSpi(xilinx.XilinxPlatform):
         return io
 
     @classmethod
-    def make(cls, target, errors=False):
+    def schedule(cls, targets):
+        def cost(target):
+            for i, family in enumerate(cls.build_order):
+                if target.startswith(family):
+                    return i
+            return len(cls.build_order)
+        return sorted(targets, key=cost)
+
+    @staticmethod
+    def digest(*data):
+        """SHA256 of this script, the migen version and `data`"""
+        with open(__file__, "rb") as f:
+            h = hashlib.sha256(f.read())
+        try:
+            from importlib import metadata
+            data += (metadata.version("migen"),)
+        except ImportError:  # Python < 3.8 or PackageNotFoundError
+            pass
+        h.update(repr(data).encode())
+        return h.hexdigest()
+
+    @classmethod
+    def up_to_date(cls, target):
+        name = os.path.join("build", "bscan_spi_{}".format(target))
+        try:
+            with open(name + ".sha256") as f:
+                stamp = f.read()
+        except FileNotFoundError:
+            return False
+        return stamp == cls.digest(target) and os.path.exists(name + ".bit")
+
+    @classmethod
+    def stamp(cls, target):
+        name = os.path.join("build", "bscan_spi_{}".format(target))
+        with open(name + ".sha256", "w") as f:
+            f.write(cls.digest(target))
+
+    @classmethod
+    def netlist_key(cls, target):
+        """Targets with the same key share the synthesized netlist"""
+        pkg, id, std, Top = cls.pinouts[target]
+        device = "{}-{}".format(target.split("-", 1)[0], pkg)
+        # the debug IOs change the logic
+        debug = device if device in cls.debug_ios else None
+        return cls.digest(Top.__name__, cls.packages[(pkg, id)], std, debug)
+
+    @classmethod
+    def make(cls, target, errors=False, run=True, threads=None, cache=False,
+             incremental=False):
+        name = "bscan_spi_{}".format(target)
+        if run and cls.up_to_date(target):
+            return name
         pkg, id, std, Top = cls.pinouts[target]
         pins = cls.packages[(pkg, id)]
         device = target.split("-", 1)[0]
         platform = cls("{}-{}".format(device, pkg), pins, std, Top.toolchain)
+        if cache and Top.toolchain == "vivado":
+            key = cls.netlist_key(target)
+            platform.toolchain.netlist = os.path.abspath(os.path.join(
+                "build", "cache", key + ".edf"))
+            # the top cell of the shared netlist names the design in the
+            # bitstream header and reports of all targets using it
+            platform.toolchain.top = "bscan_spi_{}".format(key[:16])
+            os.makedirs(os.path.dirname(platform.toolchain.netlist),
+                        exist_ok=True)
+        if incremental and Top.toolchain == "vivado":
+            platform.toolchain.incremental = True
+        if threads and Top.toolchain == "vivado":
+            # Vivado supports at most 8 threads
+            platform.toolchain.pre_synthesis_commands.append(
+                "set_param general.maxThreads {}".format(min(threads, 8)))
         top = Top(platform)
-        name = "bscan_spi_{}".format(target)
+        # the migen toolchains do not change back out of the build
+        # directory if the build fails
+        cwd = os.getcwd()
         try:
-            platform.build(top, build_name=name)
+            platform.build(top, build_name=name, run=run)
+            if run:
+                cls.stamp(target)
         except Exception as e:
             print(("ERROR: xilinx_bscan_spi build failed "
                   "for {}: {}").format(target, e))
             if errors:
                 raise
+            return None
+        finally:
+            os.chdir(cwd)
+        return name
+
+    @classmethod
+    def make_batch(cls, targets, errors=False, threads=None, cache=False,
+                   incremental=False):
+        """Build Vivado `targets` sharing a single Vivado session.
+
+        The per-target Tcl scripts are generated as usual and then sourced
+        one after the other, saving the Vivado startup time for all but the
+        first target. A batch of one is an ordinary build.
+        """
+        targets = [target for target in targets if not cls.up_to_date(target)]
+        # only cache netlists that another target in the batch will read
+        keys = [cls.netlist_key(target) for target in targets]
+        shared = {target for target, key in zip(targets, keys)
+                  if cache and keys.count(key) > 1}
+        if len(targets) <= 1:
+            for target in targets:
+                cls.make(target, errors, threads=threads,
+                         incremental=incremental)
+            return
+        names = {}
+        for target in targets:
+            name = cls.make(target, errors, run=False, threads=threads,
+                            cache=target in shared, incremental=incremental)
+            # failed to generate: do not source (and later stamp) a
+            # script left over from an earlier run
+            if name is not None:
+                names[target] = name
+        targets = list(names)
+        if not targets:
+            return
+        batch = "bscan_spi_batch_{}".format(targets[0])
+        tcl = [
+            # the migen generated scripts end in `quit`
+            "rename quit _quit",
+            "proc quit {} { close_project }",
+            "foreach build_name {{{}}} {{".format(" ".join(names.values())),
+            "    if {[catch {source $build_name.tcl} err]} {",
+            "        puts \"ERROR: xilinx_bscan_spi build failed "
+            "for $build_name: $err\"",
+            "        catch close_project",
+            "    }",
+            "}",
+            "_quit",
+        ]
+        with open(os.path.join("build", batch + ".tcl"), "w") as f:
+            f.write("\n".join(tcl))
+        try:
+            r = tools.subprocess_call_filtered(
+                ["vivado", "-mode", "batch", "-source", batch + ".tcl"],
+                common.colors, cwd="build", env=dict(os.environ, LC_ALL="C"))
+            if r != 0:
+                raise OSError("Subprocess failed")
+            # failures of individual targets do not fail the batch
+            for target, name in names.items():
+                name = os.path.join("build", name)
+                if (os.path.exists(name + ".bit") and
+                        os.path.getmtime(name + ".bit") >=
+                        os.path.getmtime(name + ".tcl")):
+                    cls.stamp(target)
+        except Exception as e:
+            print(("ERROR: xilinx_bscan_spi batch build failed "
+                  "for {}: {}").format(" ".join(targets), e))
+            if errors:
+                raise
+
+    @staticmethod
+    def quiet():
+        """Lower the priority of the current process and discard the tool
+        console output instead of filtering it through Python. The tools'
+        own log and report files are kept."""
+        if hasattr(os, "nice"):
+            os.nice(10)
+
+        def call(command, rules, **kwargs):
+            return subprocess.call(command, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, **kwargs)
+        tools.subprocess_call_filtered = call
 
 
 if __name__ == "__main__":
@@ -486,6 +796,51 @@ if __name__ == "__main__":
                    help="build for these devices (default: %(default)s)")
     p.add_argument("-p", "--parallel", default=1, type=int,
                    help="number of parallel builds (default: %(default)s)")
+    p.add_argument("-j", "--threads", type=int,
+                   help="number of Vivado threads per build "
+                   "(default: cpu count / parallel builds)")
+    p.add_argument("-c", "--cache", action="store_true",
+                   help="reuse the synthesized Vivado netlist between "
+                   "targets with the same logic and pinout (built in "
+                   "one Vivado session)")
+    p.add_argument("-i", "--incremental", action="store_true",
+                   help="reuse placement and routing of the previous "
+                   "Vivado build of each target")
+    p.add_argument("-q", "--quiet", action="store_true",
+                   help="run builds at lower priority and discard "
+                   "tool console output (see the logs in build/)")
+    p.add_argument("-b", "--batch", action="store_true",
+                   help="build Vivado targets in one Vivado session "
+                   "per parallel build")
     args = p.parse_args()
-    pool = multiprocessing.Pool(args.parallel)
-    pool.map(XilinxBscanSpi.make, args.device, chunksize=1)
+    if args.threads is None:
+        args.threads = max(1, (os.cpu_count() or 1) // args.parallel)
+    targets = XilinxBscanSpi.schedule(args.device)
+    jobs = [[target] for target in targets]
+    if args.batch or args.cache:
+        batched = [target for target in targets
+                   if XilinxBscanSpi.pinouts[target][3].toolchain == "vivado"]
+        # Targets sharing a netlist are built one after the other in the
+        # same Vivado session so that all but the first hit the cache.
+        groups = {}
+        for target in batched:
+            key = XilinxBscanSpi.netlist_key(target) if args.cache else target
+            groups.setdefault(key, []).append(target)
+        jobs = list(groups.values())
+        if args.batch:
+            jobs = [[] for i in range(args.parallel)]
+            for group in sorted(groups.values(), key=len, reverse=True):
+                min(jobs, key=len).extend(group)
+        jobs = [job for job in jobs if job]
+        jobs += [[target] for target in targets if target not in batched]
+    # fork (where available) lets the workers share the already imported
+    # modules and tables instead of re-importing them
+    if "fork" in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method("fork")
+    with multiprocessing.Pool(args.parallel, maxtasksperchild=1,
+            initializer=XilinxBscanSpi.quiet if args.quiet else None) as pool:
+        make = functools.partial(XilinxBscanSpi.make_batch,
+                                 threads=args.threads, cache=args.cache,
+                                 incremental=args.incremental)
+        for _ in pool.imap_unordered(make, jobs):
+            pass